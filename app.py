@@ -1,19 +1,30 @@
 
-import streamlit as st, io, re, time
+import streamlit as st, io, re, tempfile, hashlib
 from typing import Optional, List, Tuple
 from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
+from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.lib import colors
+from reportlab import rl_config
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     import pdfplumber
 except Exception:
     pdfplumber = None
 
+try:
+    import pypdf
+except Exception:
+    pypdf = None
+
 APP_DIR = Path(__file__).parent
 ASSETS = APP_DIR / "assets"
 
@@ -27,9 +38,13 @@ st.set_page_config(page_title="FlashDecky — study cards from any list",
                    page_icon=str(ASSETS / "icon.png"),
                    layout="wide")
 
+@st.cache_data(show_spinner=False)
+def load_css(path: Path) -> str:
+    return path.read_text()
+
 css_path = APP_DIR / "flashdecky_header.css"
 if css_path.exists():
-    st.markdown(f"<style>{css_path.read_text()}</style>", unsafe_allow_html=True)
+    st.markdown(f"<style>{load_css(css_path)}</style>", unsafe_allow_html=True)
 
 c1, c2 = st.columns([1,5])
 with c1: safe_image(ASSETS / "icon.png", width=64)
@@ -48,55 +63,111 @@ with st.sidebar:
 
 OCR_SPACE_ENDPOINT = "https://api.ocr.space/parse/image"
 
-def ocr_space_extract(file_bytes: bytes, is_pdf=False, api_key: Optional[str]=None, retries=3, backoff=1.3) -> Optional[str]:
+@st.cache_resource(show_spinner=False)
+def _ocr_session() -> requests.Session:
+    """Keep-alive session so re-uploads reuse the TLS connection to
+    api.ocr.space. Built under st.cache_resource because Streamlit re-executes
+    the module on every rerun, so a plain module global would be a fresh
+    session (and fresh handshake) each time. Transport retries (timeouts,
+    429/5xx) live in urllib3 so the caller makes exactly one logical request.
+    """
+    retry = Retry(total=3, backoff_factor=1.3, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("POST",))
+    s = requests.Session()
+    s.headers.update({"Accept-Encoding": "gzip"})
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry))
+    return s
+
+@st.cache_data(show_spinner=False, max_entries=16, ttl=3600)
+def _ocr_space_request(file_bytes: bytes, is_pdf=False, api_key: Optional[str]=None) -> str:
+    """Raises on any failure so st.cache_data only ever caches real text;
+    a transient outage must not pin a miss for the whole process."""
     key = api_key or "helloworld"
     files = {"file": ("upload.pdf" if is_pdf else "upload.png", file_bytes)}
     data = {"language":"eng","isOverlayRequired":"false","OCREngine":"2","scale":"true","detectOrientation":"true"}
-    for attempt in range(retries):
-        try:
-            r = requests.post(OCR_SPACE_ENDPOINT, files=files, data=data, headers={"apikey": key}, timeout=30)
-            if r.status_code == 200:
-                js = r.json()
-                if not js.get("IsErroredOnProcessing"):
-                    texts = [p.get("ParsedText","") for p in (js.get("ParsedResults") or [])]
-                    out = "\n".join(texts).strip()
-                    if out: return out
-            time.sleep(backoff * (attempt + 1))
-        except Exception:
-            time.sleep(backoff * (attempt + 1))
-    return None
+    r = _ocr_session().post(OCR_SPACE_ENDPOINT, files=files, data=data, headers={"apikey": key}, timeout=30)
+    r.raise_for_status()
+    js = r.json()
+    if js.get("IsErroredOnProcessing"):
+        raise RuntimeError(js.get("ErrorMessage") or "OCR.space reported a processing error")
+    out = "\n".join(p.get("ParsedText","") for p in js.get("ParsedResults") or ()).strip()
+    if not out:
+        raise RuntimeError("OCR.space returned no text")
+    return out
+
+def ocr_space_extract(file_bytes: bytes, is_pdf=False, api_key: Optional[str]=None) -> Optional[str]:
+    try:
+        return _ocr_space_request(file_bytes, is_pdf, api_key)
+    except Exception:
+        return None
 
 def pdf_text_extract(file_bytes: bytes) -> Optional[str]:
+    if pypdf:
+        try:
+            reader = pypdf.PdfReader(io.BytesIO(file_bytes))
+            txt = "\n".join(filter(None, (p.extract_text() or "" for p in reader.pages))).strip()
+            if txt: return txt
+        except Exception:
+            pass
     if not pdfplumber: return None
     try:
         with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-            chunks = []
-            for p in pdf.pages:
-                t = p.extract_text() or ""
-                if t.strip(): chunks.append(t)
-            return ("\n".join(chunks)).strip() or None
+            texts = (p.extract_text() or "" for p in pdf.pages)
+            return "\n".join(t for t in texts if t.strip()).strip() or None
     except Exception:
         return None
 
-def auto_extract(file_bytes: bytes, filename: str, api_key: Optional[str]) -> str:
+def ocr_pdf_extract(file_bytes: bytes, api_key: Optional[str]=None, max_workers: int=2) -> Optional[str]:
+    """OCR a PDF page by page so one big upload doesn't hit API size/time
+    limits; pages go out concurrently but capped to stay under rate limits."""
+    if pypdf and max_workers > 0:
+        try:
+            reader = pypdf.PdfReader(io.BytesIO(file_bytes))
+            if len(reader.pages) > 1:
+                pages = []
+                for page in reader.pages:
+                    w = pypdf.PdfWriter(); w.add_page(page)
+                    b = io.BytesIO(); w.write(b); pages.append(b.getvalue())
+                with ThreadPoolExecutor(max_workers=max_workers) as ex:
+                    texts = list(ex.map(lambda p: ocr_space_extract(p, True, api_key) or "", pages))
+                return "\n".join(t for t in texts if t).strip() or None
+        except Exception:
+            pass
+    return ocr_space_extract(file_bytes, is_pdf=True, api_key=api_key)
+
+def auto_extract(file_bytes: bytes, filename: str, api_key: Optional[str], ocr_workers: int=2) -> str:
     is_pdf = filename.lower().endswith(".pdf")
     if is_pdf:
+        # Try the native extractor first; OCR is the fallback only when the
+        # PDF has no usable text layer, so born-digital PDFs never leave the
+        # machine or spend API quota.
         txt = pdf_text_extract(file_bytes) or ""
         if len(txt.strip()) >= 20:
             return txt
-        return ocr_space_extract(file_bytes, is_pdf=True, api_key=api_key) or ""
+        return ocr_pdf_extract(file_bytes, api_key=api_key, max_workers=ocr_workers) or ""
     else:
         return ocr_space_extract(file_bytes, is_pdf=False, api_key=api_key) or ""
 
 SEP_PATTERN = re.compile(
     r'^\s*(?:\d+[\.\)]\s*)?(?:[•\-]\s*)?(?P<term>.+?)\s*(?:[\-\u2013\u2014:])\s+(?P<def>.+)\s*$'
 )
+# A line without any of these cannot match SEP_PATTERN at all.
+SEP_CHARS = ("-", "\u2013", "\u2014", ":")
+@st.cache_data(show_spinner=False, max_entries=32)
 def parse_pairs_from_text(txt: str) -> List[Tuple[str,str]]:
     raw_lines = [ln.strip() for ln in txt.splitlines() if ln.strip()]
+    # Big pastes where every line is "term - definition" skip the Python
+    # loop entirely; any non-matching (continuation) line falls through.
+    if len(raw_lines) >= 64:
+        ext = pd.Series(raw_lines).str.extract(SEP_PATTERN)
+        if not ext["term"].isna().any():
+            return list(zip(ext["term"].str.strip(), ext["def"].str.strip()))
     pairs: List[Tuple[str,str]] = []
     last_idx = -1
     for ln in raw_lines:
-        m = SEP_PATTERN.match(ln)
+        # C-level membership scans are far cheaper than letting the regex
+        # backtrack over a long continuation line that can never match.
+        m = SEP_PATTERN.match(ln) if any(ch in ln for ch in SEP_CHARS) else None
         if m:
             term = m.group("term").strip()
             definition = m.group("def").strip()
@@ -111,101 +182,177 @@ def parse_pairs_from_text(txt: str) -> List[Tuple[str,str]]:
                 pairs.append((ln, "")); last_idx = len(pairs)-1
     return pairs
 
-from reportlab.lib.pagesizes import letter
 PAGE = letter
 COLS, ROWS = 2, 4
 CARD_W, CARD_H = PAGE[0]/COLS, PAGE[1]/ROWS
 CHUNK = COLS * ROWS
-
-def wrap_lines(text, max_w, fnt="Helvetica", size=11):
+MM_TO_PT = 2.83465
+HALF_W, HALF_H = CARD_W/2, CARD_H/2
+# Centre of each card slot, indexed row-major like the batch loops below.
+SLOT_CENTERS = tuple(
+    (col*CARD_W + HALF_W, PAGE[1] - (row*CARD_H + HALF_H))
+    for row in range(ROWS) for col in range(COLS)
+)
+# Back pages mirror columns for long-edge duplex; identity when rotated 180.
+MIRROR_SLOTS = tuple(row*COLS + (COLS-1 - col) for row in range(ROWS) for col in range(COLS))
+IDENTITY_SLOTS = tuple(range(CHUNK))
+# One place for every font/colour the canvas uses.
+TERM_FONT, TERM_SIZE = "Helvetica-Bold", 13
+DEF_FONT, DEF_SIZE = "Helvetica", 11
+MARKER_FONT, MARKER_SIZE = "Helvetica", 7
+HEADER_FONT, HEADER_SIZE = "Helvetica", 8
+GRID_GREY = colors.grey
+INK = colors.black
+# Deterministic output (fixed timestamps/doc ID): identical decks produce
+# byte-identical PDFs, which keeps the Step 3 rebuild cache honest.
+rl_config.invariant = 1
+
+@lru_cache(maxsize=8)
+def _font(fnt):
+    # pdfmetrics.stringWidth re-resolves the font per call; bind it once.
+    return pdfmetrics.getFont(fnt)
+
+@lru_cache(maxsize=4096)
+def _word_width(word, fnt, size):
+    return _font(fnt).stringWidth(word, size)
+
+# Warm the metric caches at import instead of on the first build.
+for _f in (TERM_FONT, DEF_FONT):
+    _font(_f)
+
+def wrap_lines(text, max_w, fnt=DEF_FONT, size=DEF_SIZE):
     words = text.split()
-    lines, cur = [], ""
+    if not words:
+        return []
+    # Most definitions fit on one line; settle that with a single measure.
+    one_line = " ".join(words)
+    if _font(fnt).stringWidth(one_line, size) <= max_w:
+        return [one_line]
+    space_w = _word_width(" ", fnt, size)
+    lines, cur, cur_w = [], [], 0.0
     for w in words:
-        cand = (cur + " " + w).strip()
-        if stringWidth(cand, fnt, size) <= max_w: cur = cand
+        ww = _word_width(w, fnt, size)
+        cand_w = cur_w + space_w + ww if cur else ww
+        if cand_w <= max_w:
+            cur.append(w); cur_w = cand_w
         else:
-            if cur: lines.append(cur)
-            cur = w
-    if cur: lines.append(cur)
+            if cur: lines.append(" ".join(cur))
+            cur = [w]; cur_w = ww
+    if cur: lines.append(" ".join(cur))
     return lines
 
-def draw_cut_grid(c):
-    c.setLineWidth(0.5); c.setDash(3,3); c.setStrokeColor(colors.grey)
-    for i in range(1, COLS): c.line(i*CARD_W, 0, i*CARD_W, PAGE[1])
-    for j in range(1, ROWS): c.line(0, j*CARD_H, PAGE[0], j*CARD_H)
+CUT_GRID_FORM = "cut_grid"
+WATERMARK_FORM = "watermark"
+
+def define_cut_grid_form(c):
+    # Stored once in the PDF as a Form XObject; pages reference it by name.
+    c.beginForm(CUT_GRID_FORM)
+    c.setLineWidth(0.5); c.setDash(3,3); c.setStrokeColor(GRID_GREY)
+    p = c.beginPath()
+    for i in range(1, COLS):
+        p.moveTo(i*CARD_W, 0); p.lineTo(i*CARD_W, PAGE[1])
+    for j in range(1, ROWS):
+        p.moveTo(0, j*CARD_H); p.lineTo(PAGE[0], j*CARD_H)
+    c.drawPath(p)
     c.setDash()
+    c.endForm()
 
-def draw_index(c, idx, xc, yc, show_marker: bool):
-    if not show_marker: return
-    c.setFont("Helvetica", 7); c.setFillColor(colors.grey)
-    c.drawRightString(xc + CARD_W/2 - 6, yc - CARD_H/2 + 8, f"#{idx+1}")
+def draw_cut_grid(c):
+    c.doForm(CUT_GRID_FORM)
+
+def draw_markers(c, cells, start_index):
+    t = c.beginText()
+    t.setFont(MARKER_FONT, MARKER_SIZE); t.setFillColor(GRID_GREY)
+    for i, (xc, yc) in cells:
+        label = f"#{start_index + i + 1}"
+        t.setTextOrigin(xc + HALF_W - 6 - stringWidth(label, MARKER_FONT, MARKER_SIZE), yc - HALF_H + 8)
+        t.textOut(label)
+    c.drawText(t)
 
 def layout_front(c, batch, start_index, show_marker=False):
+    cells = []
+    t = c.beginText()
+    t.setFont(TERM_FONT, TERM_SIZE); t.setFillColor(INK)
     for i, item in enumerate(batch):
-        idx = start_index + i
-        col = i % COLS; row = (i // COLS) % ROWS
-        xc = col*CARD_W + CARD_W/2
-        yc = PAGE[1] - (row*CARD_H + CARD_H/2)
+        xc, yc = SLOT_CENTERS[i]
         term, definition = item
-        c.setFont("Helvetica-Bold", 13); c.setFillColor(colors.black)
-        c.drawCentredString(xc, yc-18, term)
-        draw_index(c, idx, xc, yc, show_marker)
+        t.setTextOrigin(xc - stringWidth(term, TERM_FONT, TERM_SIZE)/2, yc-18)
+        t.textOut(term)
+        cells.append((i, (xc, yc)))
+    c.drawText(t)
+    if show_marker:
+        draw_markers(c, cells, start_index)
     draw_cut_grid(c)
 
-def layout_back(c, batch, start_index, long_edge=True, offset_mm=(0,0), spelling_mode=False, show_marker=False):
-    ox = offset_mm[0] * 2.83465; oy = offset_mm[1] * 2.83465
-    c.saveState(); c.translate(ox, oy)
+def layout_back(c, batch, wrapped, start_index, long_edge=True, offset_pt=(0,0), spelling_mode=False, show_marker=False):
+    c.saveState(); c.translate(offset_pt[0], offset_pt[1])
     rotate180 = not long_edge
     if rotate180:
         c.translate(PAGE[0], PAGE[1]); c.rotate(180)
 
+    cells = []
+    slot_map = MIRROR_SLOTS if long_edge else IDENTITY_SLOTS
+    c.setStrokeColor(INK)
+    t = c.beginText()
+    t.setFont(DEF_FONT, DEF_SIZE); t.setFillColor(INK)
     for i, item in enumerate(batch):
         term, definition = item
-        col = i % COLS; row = (i // COLS) % ROWS
-        if long_edge: col = (COLS-1) - col
-        xc = col*CARD_W + CARD_W/2
-        yc = PAGE[1] - (row*CARD_H + CARD_H/2)
+        xc, yc = SLOT_CENTERS[slot_map[i]]
 
         if spelling_mode or not definition:
-            c.setStrokeColor(colors.black)
             for j in range(3):
                 y = yc - 6 + j*12
-                c.line(xc - CARD_W/2 + 10, y, xc + CARD_W/2 - 10, y)
+                c.line(xc - HALF_W + 10, y, xc + HALF_W - 10, y)
         else:
-            lines = wrap_lines(definition, CARD_W-24, "Helvetica", 11)
-            c.setFont("Helvetica", 11); c.setFillColor(colors.black)
-            start_y = yc + (len(lines)-1)*7
-            y = start_y
+            lines = wrapped[i]
+            y = yc + (len(lines)-1)*7
             for line in lines:
-                c.drawCentredString(xc, y, line); y -= 14
+                t.setTextOrigin(xc - stringWidth(line, DEF_FONT, DEF_SIZE)/2, y)
+                t.textOut(line)
+                y -= 14
 
-        draw_index(c, start_index + i, xc, yc, show_marker)
+        cells.append((i, (xc, yc)))
+    c.drawText(t)
 
+    if show_marker:
+        draw_markers(c, cells, start_index)
     draw_cut_grid(c); c.restoreState()
 
 LONG_EDGE = True
 OFFSETS_MM = (0.0, 0.0)
 SHOW_MARKER = False
 
-def build_pdf(pairs, long_edge=LONG_EDGE, offset_mm=OFFSETS_MM, show_marker=SHOW_MARKER, spelling_mode=False, watermark=None) -> bytes:
-    buf = io.BytesIO(); c = canvas.Canvas(buf, pagesize=PAGE)
+def build_pdf(pairs, long_edge=LONG_EDGE, offset_mm=OFFSETS_MM, show_marker=SHOW_MARKER, spelling_mode=False, watermark=None):
+    # Spills to disk past 8MB so huge decks don't hold the PDF in RAM twice.
+    buf = tempfile.SpooledTemporaryFile(max_size=8*1024*1024)
+    c = canvas.Canvas(buf, pagesize=PAGE, pageCompression=1)
+    define_cut_grid_form(c)
+    if watermark:
+        # Constant on every page, so store it once like the cut grid.
+        c.beginForm(WATERMARK_FORM)
+        c.setFont(HEADER_FONT, HEADER_SIZE); c.setFillColor(GRID_GREY)
+        c.drawString(20, 20, watermark)
+        c.endForm()
+    wrapped = [None if spelling_mode or not d else wrap_lines(d, CARD_W-24)
+               for _, d in pairs]
+    offset_pt = (offset_mm[0] * MM_TO_PT, offset_mm[1] * MM_TO_PT)
     start = 0; sheet = 1
     while start < len(pairs):
         batch = pairs[start:start+CHUNK]
-        c.setFont("Helvetica", 8); c.setFillColor(colors.grey)
+        c.setFont(HEADER_FONT, HEADER_SIZE); c.setFillColor(GRID_GREY)
         c.drawString(20, PAGE[1]-12, f"Sheet {sheet} FRONT ({'Long-edge' if long_edge else 'Short-edge'})")
         layout_front(c, batch, start, show_marker=show_marker)
-        if watermark: c.drawString(20, 20, watermark)
+        if watermark: c.doForm(WATERMARK_FORM)
         c.showPage()
 
-        c.setFont("Helvetica", 8); c.setFillColor(colors.grey)
+        c.setFont(HEADER_FONT, HEADER_SIZE); c.setFillColor(GRID_GREY)
         c.drawString(20, PAGE[1]-12, f"Sheet {sheet} BACK")
-        layout_back(c, batch, start, long_edge, offset_mm, spelling_mode, show_marker)
-        if watermark: c.drawString(20, 20, watermark)
+        layout_back(c, batch, wrapped[start:start+CHUNK], start, long_edge, offset_pt, spelling_mode, show_marker)
+        if watermark: c.doForm(WATERMARK_FORM)
         c.showPage()
 
         start += CHUNK; sheet += 1
-    c.save(); return buf.getvalue()
+    c.save(); buf.seek(0); return buf
 
 # Step 1
 if st.session_state.step == 1:
@@ -221,13 +368,24 @@ if st.session_state.step == 1:
         st.caption("We’ll auto-choose the best extraction for you.")
         with st.expander("Advanced extraction options", expanded=False):
             ocr_api_key = st.text_input("OCR.space API key (optional)", type="password", help="Use your key to avoid demo limits.")
+            ocr_workers = st.number_input("Parallel OCR requests (multi-page PDFs)", min_value=1, max_value=4, value=2,
+                                          help="Higher is faster but the free tier rate-limits aggressively; raise this only with your own key.")
         if up is not None:
             file_bytes = up.read()
-            with st.spinner("Extracting text…"):
-                extracted = auto_extract(file_bytes, up.name, ocr_api_key)
+            # Key the gate on content + API key so changing the key after a
+            # failed demo-tier attempt re-runs extraction. Only successful
+            # extractions are recorded, so empty results never get latched.
+            upload_key = (hashlib.blake2b(file_bytes, digest_size=16).hexdigest(), ocr_api_key)
+            if st.session_state.get("last_upload_key") == upload_key:
+                extracted = st.session_state.get("extracted_text", "")
+            else:
+                with st.spinner("Extracting text…"):
+                    extracted = auto_extract(file_bytes, up.name, ocr_api_key, ocr_workers=int(ocr_workers))
+                if extracted.strip():
+                    st.session_state.last_upload_key = upload_key
+                st.session_state.extracted_text = extracted
             if not extracted.strip():
                 st.warning("I couldn't read text from that file. Try a clearer image or paste the text instead.")
-            st.session_state.extracted_text = extracted or st.session_state.get("extracted_text","")
             st.text_area("Extracted text (you can edit before parsing):", value=st.session_state.extracted_text, height=220, key="extracted_text_box")
 
     if st.button("Next: Review and edit", type="primary"):
@@ -248,7 +406,9 @@ elif st.session_state.step == 2:
         df["Definition"] = df["Definition"].astype(str)
         st.caption("Click a cell to edit. Add/remove rows if needed.")
         df = st.data_editor(df, num_rows="dynamic", use_container_width=True, key="editor_simple")
-        st.session_state.pairs = [(str(r.Term).strip(), str(r.Definition).strip()) for r in df.itertuples(index=False)]
+        terms = df["Term"].fillna("").astype(str).str.strip()
+        defs = df["Definition"].fillna("").astype(str).str.strip()
+        st.session_state.pairs = list(zip(terms, defs))
     c1, c2 = st.columns(2)
     if c1.button("⬅ Back"):
         st.session_state.step = 1; st.rerun()
@@ -257,16 +417,30 @@ elif st.session_state.step == 2:
 
 # Step 3
 elif st.session_state.step == 3:
-    st.header("3) Download your duplex-ready PDF")
-    pairs = [(str(t or ""), str(d or "")) for t, d in st.session_state.get("pairs", [])]
-    if not pairs:
-        st.warning("No items to print. Go back and add a list.")
-    else:
-        pdf_bytes = build_pdf(pairs=pairs)
+    @st.fragment
+    def step_download():
+        st.header("3) Download your duplex-ready PDF")
+        # Both producers (parser and Step 2 cleanup) guarantee stripped strings.
+        pairs = st.session_state.get("pairs", [])
+        if not pairs:
+            st.warning("No items to print. Go back and add a list.")
+            return
+        # Rebuild only when the deck actually changed; fragment reruns
+        # (e.g. after clicking download) reuse the cached document.
+        deck_key = hashlib.blake2b(repr(pairs).encode(), digest_size=16).hexdigest()
+        if st.session_state.get("pdf_deck_key") != deck_key:
+            # Read the spooled build buffer into bytes once and cache those;
+            # closing the buffer releases any disk spill. pdf_deck_key and
+            # pdf_bytes are only ever set together here and dropped together
+            # by the "Start over" session_state.clear(), so they can't drift.
+            with build_pdf(pairs=pairs) as buf:
+                st.session_state.pdf_bytes = buf.read()
+            st.session_state.pdf_deck_key = deck_key
         st.success("PDF ready!")
-        st.download_button("⬇ Download cards PDF", data=pdf_bytes, file_name="FlashDecky_cards.pdf", mime="application/pdf", type="primary")
+        st.download_button("⬇ Download cards PDF", data=st.session_state.pdf_bytes, file_name="FlashDecky_cards.pdf", mime="application/pdf", type="primary")
         c1, c2 = st.columns(2)
         if c1.button("⬅ Back"):
             st.session_state.step = 2; st.rerun()
         if c2.button("Start over"):
             st.session_state.clear(); st.rerun()
+    step_download()